@@ -4,127 +4,423 @@ YouTube Video Downloader - Backend API
 """
 
 from flask import Flask, render_template, request, send_file, jsonify, after_this_request
+from flask.json.provider import DefaultJSONProvider
+import orjson
 import yt_dlp
 import os
+import subprocess
 import uuid
 import threading
 import time
 import re
+import copy
+import heapq
+import itertools
 import tempfile
+from dataclasses import dataclass, fields
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from urllib.parse import quote
+from cachetools import TTLCache
+from diskcache import Cache
 
-app = Flask(__name__)
 
-# Temp download directory (Render-safe)
-DOWNLOAD_FOLDER = Path(tempfile.gettempdir()) / "yt_downloads"
-DOWNLOAD_FOLDER.mkdir(exist_ok=True)
+class OrjsonProvider(DefaultJSONProvider):
+    """jsonify through orjson (the /status poll is the hot path)"""
+
+    def dumps(self, obj, **kwargs):
+        # Same JSON values, but not byte-identical to Flask's default:
+        # orjson writes raw UTF-8 where ensure_ascii gave \uXXXX escapes
+        option = orjson.OPT_SORT_KEYS if self.sort_keys else 0
+        return orjson.dumps(obj, default=self.default, option=option).decode()
 
-# In-memory status
-download_status = {}
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+app = Flask(__name__)
+app.json = OrjsonProvider(app)
+
+# Let a front server send the file (X-Sendfile). Behind nginx also set
+# X_ACCEL_PREFIX to an internal location aliased to DOWNLOAD_FOLDER, e.g.
+#   location /protected/ { internal; alias /dev/shm/yt_downloads/; }
+app.config["USE_X_SENDFILE"] = os.environ.get("USE_X_SENDFILE") == "1"
+X_ACCEL_PREFIX = os.environ.get("X_ACCEL_PREFIX")
 
 # Free tier limit (MB)
 FREE_TIER_LIMIT_MB = 500
 
 
+# Download worker threads (see EXECUTOR)
+DOWNLOAD_WORKERS = int(os.environ.get("YTDL_WORKERS", 4))
+
+
+def cgroup_memory_headroom():
+    """Bytes left under the container's memory limit, or None if unlimited"""
+    for limit_file, usage_file in (
+        ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current"),
+        ("/sys/fs/cgroup/memory/memory.limit_in_bytes",
+         "/sys/fs/cgroup/memory/memory.usage_in_bytes"),
+    ):
+        try:
+            limit = Path(limit_file).read_text().strip()
+            usage = int(Path(usage_file).read_text())
+        except (OSError, ValueError):
+            continue
+        # v1 reports "unlimited" as a huge page-aligned number
+        if limit == "max" or int(limit) >= 1 << 60:
+            return None
+        return int(limit) - usage
+    return None
+
+
+def pick_download_folder():
+    """RAM-backed /dev/shm if it can hold every worker's download, else /tmp"""
+    if os.environ.get("YTDL_DOWNLOAD_DIR"):
+        return Path(os.environ["YTDL_DOWNLOAD_DIR"])
+
+    # Merging needs room for the video+audio parts and the output, for
+    # each worker at once. tmpfs pages are charged to the container's
+    # memory cgroup, which statvfs doesn't show.
+    needed = DOWNLOAD_WORKERS * 2 * FREE_TIER_LIMIT_MB * 1024 * 1024
+    try:
+        shm = os.statvfs("/dev/shm")
+        available = shm.f_bavail * shm.f_frsize
+    except OSError:
+        available = 0
+    headroom = cgroup_memory_headroom()
+    if headroom is not None:
+        available = min(available, headroom)
+
+    if available >= needed:
+        return Path("/dev/shm") / "yt_downloads"
+    return Path(tempfile.gettempdir()) / "yt_downloads"
+
+
+# Temp download directory (Render-safe)
+DOWNLOAD_FOLDER = pick_download_folder()
+DOWNLOAD_FOLDER.mkdir(parents=True, exist_ok=True)
+IN_MEMORY_FOLDER = DOWNLOAD_FOLDER.is_relative_to("/dev/shm")
+
+
+@dataclass(slots=True)
+class DownloadStatus:
+    """One download's state; unset fields are left out of the JSON"""
+    status: str = "queued"
+    progress: int | None = None
+    filename: str | None = None
+    title: str | None = None
+    size_mb: float | None = None
+    message: str | None = None
+    version: int = 0
+
+    def to_dict(self):
+        return {
+            f.name: getattr(self, f.name)
+            for f in fields(self)
+            if getattr(self, f.name) is not None
+        }
+
+
+# In-memory status, bounded and expired along with the files.
+# Entries are only read or changed under the lock.
+download_status = TTLCache(maxsize=10000, ttl=1800)
+_status_lock = threading.RLock()
+
+# Every status write gets a new version, used as the /status ETag.
+# Long-polling requests wait on the condition for the next write.
+_status_changed = threading.Condition(_status_lock)
+_status_versions = itertools.count(1)
+
+# Max seconds /status holds an unchanged request open. Only a few polls
+# may wait at once so they can't use up the server's request threads;
+# the rest get their 304 straight away.
+STATUS_LONG_POLL = 5
+LONG_POLL_SLOTS = int(os.environ.get("YTDL_LONG_POLL_SLOTS", 4))
+_long_poll_slots = threading.BoundedSemaphore(LONG_POLL_SLOTS)
+
+# Network read timeout (s) for yt-dlp and ffmpeg alike
+SOCKET_TIMEOUT = 30
+
+# Parallel fragment downloads (cap via env on small instances)
+CONCURRENT_FRAGMENTS = int(os.environ.get("YTDL_CONCURRENT_FRAGMENTS", 8))
+
+# Bounded pool for downloads; extra requests queue instead of spawning threads
+EXECUTOR = ThreadPoolExecutor(
+    max_workers=DOWNLOAD_WORKERS,
+    thread_name_prefix="download",
+)
+
+# /stream runs ffmpeg on a request thread, so cap it the same way
+_stream_slots = threading.BoundedSemaphore(DOWNLOAD_WORKERS)
+
+# Extracted metadata by video id, so popular videos skip re-extraction
+META_TTL = 900
+meta_cache = Cache(str(DOWNLOAD_FOLDER / "meta"), size_limit=64 * 1024 * 1024)
+
+_YT_URL = re.compile(
+    r"^(?:https?://)?(?:[\w-]+\.)?(?:youtube\.com|youtu\.be|youtube-nocookie\.com)/", re.I
+)
+_VIDEO_ID = re.compile(r"(?:v=|youtu\.be/|shorts/|embed/)([\w-]{11})")
+
+# Files are kept for 30 minutes, 10 when they live in RAM
+FILE_TTL = 600 if IN_MEMORY_FOLDER else 1800
+
+# Pending deletions as a min-heap of (expire_at, seq, path, download_id)
+_expiry_heap = []
+_expiry_cond = threading.Condition()
+_expiry_seq = itertools.count()
+
+
+def schedule_deletion(path, delay=FILE_TTL, download_id=None):
+    """Queue a file (and optionally its status entry) for deletion"""
+    with _expiry_cond:
+        heapq.heappush(
+            _expiry_heap,
+            (time.time() + delay, next(_expiry_seq), Path(path), download_id),
+        )
+        _expiry_cond.notify()
+
+
 def cleanup_old_files():
-    """Delete files older than 30 minutes"""
+    """Delete queued files as their deadlines pass"""
     while True:
-        now = time.time()
+        with _expiry_cond:
+            while not _expiry_heap:
+                _expiry_cond.wait()
+            expire_at, _, path, download_id = _expiry_heap[0]
+            remaining = expire_at - time.time()
+            if remaining > 0:
+                # Woken early if a sooner deadline is pushed
+                _expiry_cond.wait(remaining)
+                continue
+            heapq.heappop(_expiry_heap)
         try:
-            for f in DOWNLOAD_FOLDER.glob("*"):
-                if now - f.stat().st_mtime > 1800:
-                    f.unlink(missing_ok=True)
+            path.unlink(missing_ok=True)
+            if download_id:
+                pop_status(download_id)
         except Exception as e:
             print("Cleanup error:", e)
-        time.sleep(300)
 
 
+def expire_partial_files(download_id):
+    """Queue leftovers (.part, unmerged formats) of a failed download"""
+    for f in DOWNLOAD_FOLDER.glob(f"{download_id}.*"):
+        schedule_deletion(f)
+
+
+# Files left behind by a previous process keep their original deadline
+for _f in DOWNLOAD_FOLDER.glob("*"):
+    if _f.is_file():
+        schedule_deletion(_f, max(0, _f.stat().st_mtime + FILE_TTL - time.time()))
+
 threading.Thread(target=cleanup_old_files, daemon=True).start()
 
 
+def set_status(download_id, **values):
+    with _status_changed:
+        download_status[download_id] = DownloadStatus(
+            **values, version=next(_status_versions)
+        )
+        _status_changed.notify_all()
+
+
+def update_status(download_id, **values):
+    with _status_changed:
+        entry = download_status.get(download_id)
+        if entry is None:
+            return
+        for name, value in values.items():
+            setattr(entry, name, value)
+        entry.version = next(_status_versions)
+        # Re-store to refresh the TTL of long-running downloads
+        download_status[download_id] = entry
+        _status_changed.notify_all()
+
+
+def get_status(download_id):
+    """Snapshot of the entry as a dict, or None"""
+    with _status_lock:
+        entry = download_status.get(download_id)
+        return entry.to_dict() if entry else None
+
+
+def pop_status(download_id):
+    with _status_lock:
+        download_status.pop(download_id, None)
+
+
+_SANITIZE_DROP = re.compile(r"[^\w\s-]")
+_SANITIZE_WS = re.compile(r"\s+")
+
+
 def sanitize_filename(title):
-    title = re.sub(r"[^\w\s-]", "", title)
-    title = re.sub(r"\s+", " ", title)
-    return title.strip()[:100]
+    return _SANITIZE_WS.sub(" ", _SANITIZE_DROP.sub("", title)).strip()[:100]
 
 
-def update_progress(d, download_id):
-    if d["status"] == "downloading":
-        try:
-            percent = d.get("_percent_str", "0%").replace("%", "").strip()
-            download_status[download_id]["progress"] = float(percent)
-        except:
-            pass
+def update_progress(d):
+    if d["status"] != "downloading":
+        return
 
+    # Integer math on the byte counts instead of parsing _percent_str
+    total = d.get("total_bytes") or d.get("total_bytes_estimate")
+    if not total:
+        return
+    percent = min(100, int(d.get("downloaded_bytes", 0) * 100 // total))
 
-def download_video(url, download_id):
-    try:
-        output_template = str(DOWNLOAD_FOLDER / f"{download_id}.%(ext)s")
-
-        ydl_opts = {
-            # OUTPUT
-            "outtmpl": output_template,
-            "merge_output_format": "mp4",
-
-            # ✅ BEST QUALITY (NO DOWNGRADE)
-            "format": "bestvideo[height<=2160]+bestaudio/best",
-
-            # QUIET
-            "quiet": True,
-            "no_warnings": True,
-
-            # 🔥 ANDROID CLIENT (ANTI-BOT)
-            "extractor_args": {
-                "youtube": {
-                    "player_client": ["android"],
-                    "player_skip": ["webpage", "configs"],
-                }
-            },
-
-            # ANDROID HEADERS
-            "http_headers": {
-                "User-Agent": (
-                    "com.google.android.youtube/17.36.4 "
-                    "(Linux; Android 12)"
-                ),
-                "Accept-Language": "en-US,en;q=0.9",
-            },
-
-            # FFmpeg merge → PERFECT SYNC
-            "force_ipv4": True,
-            "socket_timeout": 30,
-            "concurrent_fragment_downloads": 1,
-
-            "progress_hooks": [lambda d: update_progress(d, download_id)],
+    # Files are named {download_id}.<ext>, so one hook serves all
+    download_id = Path(d["filename"]).name.split(".", 1)[0]
+
+    with _status_changed:
+        entry = download_status.get(download_id)
+        # Only publish whole-percent steps to avoid churn and poll wakeups
+        if entry is not None and entry.progress != percent:
+            update_status(download_id, progress=percent)
+
+
+# Download options (outtmpl is set per download)
+YDL_DOWNLOAD_OPTS = {
+    # watch?v=X&list=Y means video X, not the whole playlist
+    "noplaylist": True,
+
+    # FFmpegMerger muxes with -c copy, so no re-encode happens here. Don't
+    # add FFmpegVideoConvertor (it transcodes); if a container change is
+    # ever needed use {"key": "FFmpegVideoRemuxer", "preferedformat": "mp4"}
+    "merge_output_format": "mp4",
+
+    # ✅ BEST QUALITY (NO DOWNGRADE)
+    "format": "bestvideo[height<=2160]+bestaudio/best",
+
+    # QUIET
+    "quiet": True,
+    "no_warnings": True,
+
+    # 🔥 ANDROID CLIENT (ANTI-BOT)
+    "extractor_args": {
+        "youtube": {
+            "player_client": ["android"],
+            "player_skip": ["webpage", "configs"],
         }
+    },
+
+    # ANDROID HEADERS
+    "http_headers": {
+        "User-Agent": (
+            "com.google.android.youtube/17.36.4 "
+            "(Linux; Android 12)"
+        ),
+        "Accept-Language": "en-US,en;q=0.9",
+    },
+
+    # FFmpeg merge → PERFECT SYNC
+    "force_ipv4": True,
+    "socket_timeout": SOCKET_TIMEOUT,
+    "concurrent_fragment_downloads": CONCURRENT_FRAGMENTS,
+    "http_chunk_size": 10 * 1024 * 1024,
+    "retries": 3,
+    "fragment_retries": 3,
+
+    "progress_hooks": [update_progress],
+}
+
+# Metadata-only options for the size pre-check
+YDL_INFO_OPTS = {
+    "noplaylist": True,
+    "quiet": True,
+    "no_warnings": True,
+    "extractor_args": {
+        "youtube": {
+            "player_client": ["android"],
+        }
+    },
+    "http_headers": {
+        "User-Agent": (
+            "com.google.android.youtube/17.36.4 "
+            "(Linux; Android 12)"
+        )
+    },
+}
+
+# Streaming options: same quality as downloads, but only plain HTTPS
+# formats that ffmpeg can read directly (no DASH fragment lists)
+YDL_STREAM_OPTS = {
+    **YDL_INFO_OPTS,
+    "format": (
+        "bestvideo[height<=2160][protocol=https]+bestaudio[protocol=https]"
+        "/best[protocol=https]"
+    ),
+}
+
+# YoutubeDL is costly to build and not thread-safe, so each thread
+# keeps one instance per option set and reuses it
+_ydl_local = threading.local()
+
+
+def get_ydl(name, opts):
+    instances = _ydl_local.__dict__.setdefault("instances", {})
+    if name not in instances:
+        # YoutubeDL keeps and mutates the dict it is given
+        instances[name] = yt_dlp.YoutubeDL(copy.deepcopy(opts))
+    return instances[name]
+
+
+def fetch_info(url):
+    """Metadata for url, served from meta_cache when possible"""
+    match = _VIDEO_ID.search(url)
+    video_id = match.group(1) if match else None
+
+    info = meta_cache.get(video_id) if video_id else None
+    if info is None:
+        ydl = get_ydl("info", YDL_INFO_OPTS)
+        # Drop the pre-check's own format choice (requested_formats etc.) so
+        # whoever processes this dict next selects formats from scratch
+        info = ydl.sanitize_info(
+            ydl.extract_info(url, download=False), remove_private_keys=True
+        )
+        # Only cache a single video under its own id
+        if info.get("_type", "video") == "video" and info.get("id") == video_id:
+            meta_cache.set(video_id, info, expire=META_TTL)
+    return info
+
+
+def download_video(url, download_id, info=None):
+    try:
+        ydl = get_ydl("download", YDL_DOWNLOAD_OPTS)
+        ydl.params["outtmpl"]["default"] = str(DOWNLOAD_FOLDER / f"{download_id}.%(ext)s")
 
-        download_status[download_id] = {"status": "downloading", "progress": 0}
+        set_status(download_id, status="downloading", progress=0)
 
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        # Reuse the pre-check metadata instead of extracting twice
+        if info is not None:
+            info = ydl.process_ie_result(info, download=True)
+        else:
             info = ydl.extract_info(url, download=True)
 
-            filesize = info.get("filesize") or info.get("filesize_approx") or 0
-            size_mb = round(filesize / (1024 * 1024), 1)
-
-            for file in DOWNLOAD_FOLDER.glob(f"{download_id}*.mp4"):
-                download_status[download_id] = {
-                    "status": "complete",
-                    "filename": file.name,
-                    "title": sanitize_filename(info.get("title", "video")),
-                    "size_mb": size_mb,
-                }
-                return
-
-        download_status[download_id] = {
-            "status": "error",
-            "message": "Download failed",
-        }
+        filesize = info.get("filesize") or info.get("filesize_approx") or 0
+        size_mb = round(filesize / (1024 * 1024), 1)
+
+        # yt-dlp reports the final path; merge_output_format pins it otherwise
+        requested = info.get("requested_downloads") or [{}]
+        filepath = requested[0].get("filepath")
+        final = Path(filepath) if filepath else DOWNLOAD_FOLDER / f"{download_id}.mp4"
+
+        if filepath or final.exists():
+            schedule_deletion(final)
+            set_status(
+                download_id,
+                status="complete",
+                filename=final.name,
+                title=sanitize_filename(info.get("title", "video")),
+                size_mb=size_mb,
+            )
+            return
+
+        expire_partial_files(download_id)
+        set_status(download_id, status="error", message="Download failed")
 
     except Exception as e:
-        download_status[download_id] = {
-            "status": "error",
-            "message": str(e),
-        }
+        expire_partial_files(download_id)
+        set_status(download_id, status="error", message=str(e))
 
 
 @app.route("/")
@@ -140,60 +436,85 @@ def start_download():
     if not url:
         return jsonify({"error": "No URL provided"}), 400
 
-    if "youtube.com" not in url and "youtu.be" not in url:
+    if not _YT_URL.match(url):
         return jsonify({"error": "Invalid YouTube URL"}), 400
 
-    # Pre-check size
+    # Pre-check size (info is handed to the worker to skip a 2nd fetch)
+    info = None
     try:
-        ydl_opts_info = {
-            "quiet": True,
-            "no_warnings": True,
-            "extractor_args": {
-                "youtube": {
-                    "player_client": ["android"],
-                }
-            },
-            "http_headers": {
-                "User-Agent": (
-                    "com.google.android.youtube/17.36.4 "
-                    "(Linux; Android 12)"
-                )
-            },
-        }
-
-        with yt_dlp.YoutubeDL(ydl_opts_info) as ydl:
-            info = ydl.extract_info(url, download=False)
-            size = info.get("filesize") or info.get("filesize_approx") or 0
-            size_mb = size / (1024 * 1024)
+        info = fetch_info(url)
+        size = info.get("filesize") or info.get("filesize_approx") or 0
+        size_mb = size / (1024 * 1024)
 
-            if size_mb > FREE_TIER_LIMIT_MB:
-                return jsonify({
-                    "error": "size_limit",
-                    "size_mb": round(size_mb, 1),
-                    "limit_mb": FREE_TIER_LIMIT_MB,
-                }), 403
+        if size_mb > FREE_TIER_LIMIT_MB:
+            return jsonify({
+                "error": "size_limit",
+                "size_mb": round(size_mb, 1),
+                "limit_mb": FREE_TIER_LIMIT_MB,
+            }), 403
 
     except Exception as e:
         print("Size check failed:", e)
+        info = None
 
     download_id = str(uuid.uuid4())
-    threading.Thread(
-        target=download_video,
-        args=(url, download_id),
-        daemon=True,
-    ).start()
+    set_status(download_id, status="queued", progress=0)
+    EXECUTOR.submit(download_video, url, download_id, info)
 
     return jsonify({"download_id": download_id})
 
 
 @app.route("/status/<download_id>")
 def status(download_id):
-    return jsonify(download_status.get(download_id, {"status": "not_found"}))
+    etags = request.if_none_match
+
+    with _status_changed:
+        entry = download_status.get(download_id)
+        # Client already has this state: hold the poll until it changes.
+        # Only active downloads change soon; queued/finished ones answer now.
+        if (
+            entry
+            and entry.status == "downloading"
+            and etags.contains(str(entry.version))
+            and _long_poll_slots.acquire(blocking=False)
+        ):
+            seen = entry.version
+            try:
+                _status_changed.wait_for(
+                    lambda: getattr(download_status.get(download_id), "version", None) != seen,
+                    timeout=STATUS_LONG_POLL,
+                )
+            finally:
+                _long_poll_slots.release()
+            entry = download_status.get(download_id)
+        entry = entry.to_dict() if entry else None
+
+    if entry is None:
+        return jsonify({"status": "not_found"})
+
+    etag = str(entry["version"])
+    if etags.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(entry)
+
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+
+# mimetypes thinks .3gp is audio; anything else is guessed from the name
+VIDEO_MIMETYPES = {
+    ".mp4": "video/mp4",
+    ".webm": "video/webm",
+    ".3gp": "video/3gpp",
+    ".mkv": "video/x-matroska",
+}
 
 
 @app.route("/get/<download_id>")
 def get_file(download_id):
-    status = download_status.get(download_id)
+    status = get_status(download_id)
 
     if not status or status["status"] != "complete":
         return jsonify({"error": "Not ready"}), 404
@@ -205,21 +526,130 @@ def get_file(download_id):
 
     @after_this_request
     def cleanup(response):
-        def delayed():
-            time.sleep(5)
-            filepath.unlink(missing_ok=True)
-            download_status.pop(download_id, None)
-        threading.Thread(target=delayed, daemon=True).start()
+        schedule_deletion(filepath, 5, download_id)
         return response
 
-    return send_file(
+    # Usually .mp4 (merged), but a /best fallback keeps its own container
+    response = send_file(
         filepath,
         as_attachment=True,
-        download_name=f"{status['title']}.mp4",
-        mimetype="video/mp4",
+        download_name=f"{status['title']}{filepath.suffix}",
+        mimetype=VIDEO_MIMETYPES.get(filepath.suffix.lower()),
     )
 
+    # nginx uses its own header with an internal URI instead of a path
+    if X_ACCEL_PREFIX and "X-Sendfile" in response.headers:
+        del response.headers["X-Sendfile"]
+        response.headers["X-Accel-Redirect"] = f"{X_ACCEL_PREFIX.rstrip('/')}/{filepath.name}"
+
+    return response
 
+
+@app.route("/stream")
+def stream():
+    """Mux straight from YouTube to the client, no file on disk"""
+    url = request.args.get("url", "").strip()
+
+    if not _YT_URL.match(url):
+        return jsonify({"error": "Invalid YouTube URL"}), 400
+
+    if not _stream_slots.acquire(blocking=False):
+        return jsonify({"error": "Too many streams, use /download"}), 503
+
+    # The slot is held until the body is closed, or released on error
+    try:
+        response = app.make_response(stream_response(url))
+    except Exception:
+        _stream_slots.release()
+        raise
+    if response.status_code == 200:
+        response.call_on_close(_stream_slots.release)
+    else:
+        _stream_slots.release()
+    return response
+
+
+def stream_response(url):
+    """ffmpeg-backed MP4 response for url, or an error response"""
+    try:
+        ydl = get_ydl("stream", YDL_STREAM_OPTS)
+        info = ydl.process_ie_result(fetch_info(url), download=False)
+    except Exception as e:
+        # No streamable format; /download still works
+        return jsonify({"error": str(e)}), 502
+
+    size = info.get("filesize") or info.get("filesize_approx") or 0
+    size_mb = size / (1024 * 1024)
+
+    if size_mb > FREE_TIER_LIMIT_MB:
+        return jsonify({
+            "error": "size_limit",
+            "size_mb": round(size_mb, 1),
+            "limit_mb": FREE_TIER_LIMIT_MB,
+        }), 403
+
+    # Remux (-c copy) video+audio into fragmented MP4 on stdout
+    cmd = ["ffmpeg", "-loglevel", "error"]
+    formats = info.get("requested_formats") or [info]
+    for f in formats:
+        headers = "".join(f"{k}: {v}\r\n" for k, v in f.get("http_headers", {}).items())
+        if headers:
+            cmd += ["-headers", headers]
+        # ffmpeg's HTTP reads never time out by default (value in µs)
+        cmd += ["-rw_timeout", str(SOCKET_TIMEOUT * 1_000_000), "-i", f["url"]]
+    for i in range(len(formats)):
+        cmd += ["-map", str(i)]
+    cmd += ["-c", "copy", "-movflags", "frag_keyframe+empty_moov", "-f", "mp4", "pipe:1"]
+
+    # stderr goes to a temp file so a chatty ffmpeg can't block on a full pipe
+    errors = tempfile.TemporaryFile()
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=errors)
+    except OSError as e:
+        errors.close()
+        print("ffmpeg failed to start:", e)
+        return jsonify({"error": "Stream failed"}), 502
+
+    def ffmpeg_errors():
+        errors.seek(0)
+        return errors.read().decode(errors="replace").strip()
+
+    def cleanup():
+        # Client gone or done: don't leave ffmpeg running
+        proc.kill()
+        proc.wait()
+        errors.close()
+
+    def generate():
+        yield first
+        yield from iter(lambda: proc.stdout.read(1 << 20), b"")
+        if proc.wait() != 0:
+            print(f"ffmpeg exited with {proc.returncode} mid-stream:", ffmpeg_errors())
+
+    # Until call_on_close owns cleanup, any failure must reap ffmpeg here
+    try:
+        # Inputs are opened before any output, so a bad URL/header shows up
+        # as EOF here and can still be reported as an error
+        first = proc.stdout.read1(1 << 20)
+        if not first:
+            proc.wait()
+            print(f"ffmpeg exited with {proc.returncode}:", ffmpeg_errors())
+            cleanup()
+            return jsonify({"error": "Stream failed"}), 502
+
+        response = app.response_class(generate(), mimetype="video/mp4")
+        title = sanitize_filename(info.get("title", "video")) or "video"
+        response.headers["Content-Disposition"] = (
+            f"attachment; filename*=UTF-8''{quote(title + '.mp4')}"
+        )
+        response.call_on_close(cleanup)
+    except BaseException:
+        cleanup()
+        raise
+    return response
+
+
+# Local development only; production runs under gunicorn (see Procfile)
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port)
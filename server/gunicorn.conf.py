@@ -0,0 +1,23 @@
+"""
+Gunicorn config - production server for the API
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+
+# Download status lives in process memory, so keep a single worker
+# and get concurrency from threads instead. Budget: up to
+# YTDL_LONG_POLL_SLOTS (4) waiting /status polls + YTDL_WORKERS (4)
+# /stream transfers, leaving the rest for pages, /download and /get.
+workers = 1
+threads = int(os.environ.get("GUNICORN_THREADS", 16))
+worker_class = "gthread"
+
+# yt-dlp downloads run in background threads, but /get can stream
+# large files for a long time
+timeout = 0
+
+# send_file hands gunicorn a wsgi.file_wrapper, which it transmits with
+# os.sendfile (page cache -> socket, no userspace copy)
+sendfile = True